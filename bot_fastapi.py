@@ -1,80 +1,41 @@
 import os
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import List
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-import chromadb
+import numpy as np
 from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+from chromadb.errors import InvalidCollectionException
+from openai import AsyncOpenAI
+from diskcache import Cache
+from models import EMBED_ID, encode, get_chroma, get_embedder
 
 # === Load environment ===
 load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
 # === Constants ===
-CHROMA_DIR = "chroma_store"
-EMBED_MODEL = "BAAI/bge-large-en-v1.5"
+EMBED_CACHE_DIR = "cache/embeddings"
+EMBED_CACHE_SIZE = 256 << 20  # bytes on disk, ~25k queries at bge-large's 1024 dims
+ANSWER_CACHE_DIR = "cache/answers"
+ANSWER_CACHE_TTL = 24 * 60 * 60  # seconds; answers go stale once a collection is re-indexed
+ANSWER_SIMILARITY = 0.95
+ANSWER_INDEX_SIZE = 5000  # most recent answered queries kept for semantic lookup
 LLM_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
 MAX_TOKENS = 700
+EMBED_WORKERS = 2
+CONTEXT_K = 8  # chunks kept for the prompt out of the top_k retrieved
+MMR_LAMBDA = 0.7  # relevance vs. diversity trade-off when picking them
 
-# === Load models and client ===
-print("Loading embedding model...")
-embedder = SentenceTransformer(EMBED_MODEL)
-
-print("Loading Groq LLM client...")
-llm_client = OpenAI(
-    api_key=GROQ_API_KEY,
-    base_url="https://api.groq.com/openai/v1"
-)
-
-print("Loading ChromaDB...")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
-
-# === FastAPI app ===
-app = FastAPI(title="NBC RAG Assistant")
-
-# === Request schema ===
-class ChatRequest(BaseModel):
-    collection_id: str
-    query: str
-    top_k: int = 15
-
-# === Chat endpoint ===
-@app.post("/chat")
-def chat_with_nbc(req: ChatRequest):
-    try:
-        # Load collection dynamically
-        collection = chroma_client.get_collection(name=req.collection_id)
-    except Exception:
-        raise HTTPException(status_code=404, detail=f"Collection '{req.collection_id}' not found.")
-
-    # Encode query
-    query_embedding = embedder.encode(req.query).tolist()
-
-    try:
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=req.top_k
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"ChromaDB query failed: {e}")
-
-    documents = results["documents"][0]
-    metadatas = results["metadatas"][0]
-
-    if not documents:
-        return {"answer": "No relevant context found for your query."}
-
-    # Build context string
-    context_str = ""
-    for i, (chunk, meta) in enumerate(zip(documents, metadatas)):
-        clause = meta.get("clause", "N/A")
-        page = meta.get("page", "Unknown")
-        context_str += f"[{i+1}] Page {page} | Clause {clause}:\n{chunk.strip()}\n\n"
-
-    # Prompt
-    prompt = f"""You are a senior building code consultant specializing in the National Building Code (NBC) of India 2016 Volume 1.
+# === Prompt ===
+SYSTEM_PROMPT = """You are a senior building code consultant specializing in the National Building Code (NBC) of India 2016 Volume 1.
 
 Your job is to answer user questions using only the provided NBC context. You must ensure clarity, accuracy, and reference every answer to relevant clauses and pages.
 
@@ -105,59 +66,179 @@ Reference:
 ---
 
 Tone: Professional, concise, fact-based — no opinions, filler, or friendly small talk.
-
-Context:
-{context_str}
-
-Question: {req.query}
 """
 
-    try:
-        response = llm_client.chat.completions.create(
-            model=LLM_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-            max_tokens=MAX_TOKENS
-        )
-        return {"answer": response.choices[0].message.content.strip()}
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"LLM failed: {e}")
-import os
-from typing import List
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from dotenv import load_dotenv
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
-
-# === Load environment ===
-load_dotenv()
-GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-
-# === Constants ===
-CHROMA_DIR = "chroma_store"
-EMBED_MODEL = "BAAI/bge-large-en-v1.5"
-LLM_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
-MAX_TOKENS = 700
-
 # === Load models and client ===
-print("Loading embedding model...")
-embedder = SentenceTransformer(EMBED_MODEL)
+# Encoding is CPU/GPU bound; a small dedicated pool keeps it off the event loop
+EMBED_POOL = ThreadPoolExecutor(max_workers=EMBED_WORKERS)
 
 print("Loading Groq LLM client...")
-llm_client = OpenAI(
+llm_client = AsyncOpenAI(
     api_key=GROQ_API_KEY,
     base_url="https://api.groq.com/openai/v1"
 )
 
 print("Loading ChromaDB...")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
+chroma_client = get_chroma()
+
+print("Loading embedding cache...")
+# Explicit policy: directories created by the old unbounded Index store "none"
+embed_cache = Cache(
+    EMBED_CACHE_DIR, size_limit=EMBED_CACHE_SIZE, eviction_policy="least-recently-stored"
+)
+
+print("Loading answer cache...")
+answer_cache = Cache(ANSWER_CACHE_DIR)
+
+# === Query embedding cache ===
+def _normalize_query(query: str) -> str:
+    return " ".join(query.split())
+
+
+@lru_cache(maxsize=2048)
+def _encode_query(query: str) -> tuple:
+    # Persisted by SHA-256 of model/backend + normalized query so restarts stay warm
+    key = hashlib.sha256(f"{EMBED_ID}\n{query}".encode("utf-8")).hexdigest()
+    embedding = embed_cache.get(key)
+    if embedding is None:
+        embedding = tuple(encode(query, normalize_embeddings=True).tolist())
+        embed_cache[key] = embedding
+    return embedding
+
+# === Collection handles ===
+@lru_cache(maxsize=64)
+def _get_collection(collection_id: str):
+    return chroma_client.get_collection(name=collection_id)
+
+
+def _query_collection(collection_id: str, query_embedding, n_results: int):
+    query = {
+        "query_embeddings": [query_embedding],
+        "n_results": n_results,
+        "include": ["documents", "metadatas", "embeddings"]
+    }
+    try:
+        results = _get_collection(collection_id).query(**query)
+        # embed.py and the upload service's HNSW rebuild recreate collections from another
+        # process; Chroma keeps serving the old in-memory index, whose rows are gone (None)
+        if None not in results["documents"][0]:
+            return results
+    except InvalidCollectionException:
+        pass  # deleted or rebuilt by this process
+    # The cached handle is stale; look the collection up by name again and retry once
+    _get_collection.cache_clear()
+    try:
+        collection = _get_collection(collection_id)
+    except ValueError:
+        # get_collection raises ValueError for a missing name; keep it on the 404 path
+        raise InvalidCollectionException(f"Collection {collection_id} does not exist.")
+    return collection.query(**query)
+
+# === Context selection ===
+def _select_mmr(query_embedding, embeddings, k: int) -> list:
+    # Maximal Marginal Relevance over normalized vectors: relevant chunks that don't repeat each other
+    doc_matrix = np.asarray(embeddings, dtype=np.float32)
+    relevance = doc_matrix @ np.asarray(query_embedding, dtype=np.float32)
+    similarity = doc_matrix @ doc_matrix.T
+
+    selected = [int(relevance.argmax())]
+    candidates = [i for i in range(len(doc_matrix)) if i != selected[0]]
+    while candidates and len(selected) < k:
+        redundancy = similarity[np.ix_(candidates, selected)].max(axis=1)
+        scores = MMR_LAMBDA * relevance[candidates] - (1 - MMR_LAMBDA) * redundancy
+        selected.append(candidates.pop(int(scores.argmax())))
+    return selected
+
+# === Answer cache ===
+# (embed_id, collection_id, top_k) -> [ring of answered query embeddings, parallel cache keys, rows written]
+_answer_index = {}
+_answer_lock = threading.Lock()
+
+
+def _answer_key(collection_id: str, top_k: int, query: str) -> tuple:
+    return (EMBED_ID, collection_id, top_k, hashlib.sha256(query.encode("utf-8")).hexdigest())
+
+
+def _new_answer_ring(rows: np.ndarray, keys: list) -> list:
+    # Preallocated once per group so storing an answer is a single row write, not a re-stack
+    rows, keys = rows[-ANSWER_INDEX_SIZE:], keys[-ANSWER_INDEX_SIZE:]
+    matrix = np.zeros((ANSWER_INDEX_SIZE, rows.shape[1]), dtype=np.float32)
+    matrix[:len(rows)] = rows
+    return [matrix, keys + [None] * (ANSWER_INDEX_SIZE - len(keys)), len(keys)]
+
+
+def _index_answer(key: tuple, embedding) -> None:
+    row = np.asarray(embedding, dtype=np.float32)
+    with _answer_lock:
+        ring = _answer_index.get(key[:3])
+        if ring is None:
+            _answer_index[key[:3]] = _new_answer_ring(row[None, :], [key])
+            return
+        # Once full, overwrite the oldest slot
+        slot = ring[2] % ANSWER_INDEX_SIZE
+        ring[0][slot] = row
+        ring[1][slot] = key
+        ring[2] += 1
+
+
+def _get_cached_answer(key: tuple, embedding):
+    entry = answer_cache.get(key)
+    if entry is not None:
+        return entry["answer"]
+
+    # Semantic fallback: reuse the answer to a near-identical earlier question.
+    # Scored under the lock since stores overwrite ring rows in place.
+    with _answer_lock:
+        ring = _answer_index.get(key[:3])
+        if ring is None:
+            return None
+        matrix, keys, written = ring
+        scores = matrix[:min(written, ANSWER_INDEX_SIZE)] @ np.asarray(embedding, dtype=np.float32)
+        best = int(scores.argmax())
+        best_score, best_key = scores[best], keys[best]
+    if best_score < ANSWER_SIMILARITY:
+        return None
+    entry = answer_cache.get(best_key)
+    return entry["answer"] if entry is not None else None
+
+
+def _store_answer(key: tuple, embedding, answer: str) -> None:
+    # An empty completion would be served for the whole TTL, and to every paraphrase
+    if not answer:
+        return
+    answer_cache.set(key, {"embedding": embedding, "answer": answer}, expire=ANSWER_CACHE_TTL)
+    _index_answer(key, embedding)
+
+
+def _load_answer_index() -> None:
+    # Group first and stack once per group; indexing entry by entry is quadratic
+    groups = {}
+    for key in answer_cache:
+        entry = answer_cache.get(key)
+        if entry is not None:
+            rows, keys = groups.setdefault(key[:3], ([], []))
+            rows.append(entry["embedding"])
+            keys.append(key)
+    rings = {
+        group: _new_answer_ring(np.asarray(rows[-ANSWER_INDEX_SIZE:], dtype=np.float32), keys)
+        for group, (rows, keys) in groups.items()
+    }
+    with _answer_lock:
+        _answer_index.update(rings)
 
 # === FastAPI app ===
-app = FastAPI(title="NBC RAG Assistant")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Heavy loading happens at startup, not at import, so importing the module stays cheap
+    loop = asyncio.get_running_loop()
+    print("Loading embedding model...")
+    await loop.run_in_executor(EMBED_POOL, get_embedder)
+    print("Loading answer index...")
+    await loop.run_in_executor(None, _load_answer_index)
+    yield
+
+
+app = FastAPI(title="NBC RAG Assistant", lifespan=lifespan)
 
 # === Request schema ===
 class ChatRequest(BaseModel):
@@ -165,23 +246,31 @@ class ChatRequest(BaseModel):
     query: str
     top_k: int = 15
 
-# === Chat endpoint ===
-@app.post("/chat")
-def chat_with_nbc(req: ChatRequest):
+# === Chat pipeline ===
+# Returns (answer_key, query_embedding, answer, messages); answer is set when no LLM call is needed
+async def _prepare_chat(req: ChatRequest):
+    loop = asyncio.get_running_loop()
     try:
         # Load collection dynamically
-        collection = chroma_client.get_collection(name=req.collection_id)
+        await loop.run_in_executor(None, _get_collection, req.collection_id)
     except Exception:
         raise HTTPException(status_code=404, detail=f"Collection '{req.collection_id}' not found.")
 
-    # Encode query
-    query_embedding = embedder.encode(req.query).tolist()
+    # Encode query (cached)
+    query = _normalize_query(req.query)
+    query_embedding = list(await loop.run_in_executor(EMBED_POOL, _encode_query, query))
+
+    answer_key = _answer_key(req.collection_id, req.top_k, query)
+    cached_answer = await loop.run_in_executor(None, _get_cached_answer, answer_key, query_embedding)
+    if cached_answer is not None:
+        return answer_key, query_embedding, cached_answer, None
 
     try:
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=req.top_k
+        results = await loop.run_in_executor(
+            None, _query_collection, req.collection_id, query_embedding, req.top_k
         )
+    except InvalidCollectionException:
+        raise HTTPException(status_code=404, detail=f"Collection '{req.collection_id}' not found.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"ChromaDB query failed: {e}")
 
@@ -189,62 +278,96 @@ def chat_with_nbc(req: ChatRequest):
     metadatas = results["metadatas"][0]
 
     if not documents:
-        return {"answer": "No relevant context found for your query."}
+        return answer_key, query_embedding, "No relevant context found for your query.", None
+
+    # Retrieve wide, prompt narrow: fewer prompt tokens for the LLM
+    selected = _select_mmr(query_embedding, results["embeddings"][0], CONTEXT_K)
+    documents = [documents[i] for i in selected]
+    metadatas = [metadatas[i] for i in selected]
 
     # Build context string
-    context_str = ""
-    for i, (chunk, meta) in enumerate(zip(documents, metadatas)):
-        clause = meta.get("clause", "N/A")
-        page = meta.get("page", "Unknown")
-        context_str += f"[{i+1}] Page {page} | Clause {clause}:\n{chunk.strip()}\n\n"
+    context_str = "".join(
+        f"[{i+1}] Page {meta.get('page', 'Unknown')} | Clause {meta.get('clause', 'N/A')}:\n{chunk.strip()}\n\n"
+        for i, (chunk, meta) in enumerate(zip(documents, metadatas))
+    )
 
-    # Prompt
-    prompt = f"""You are a senior building code consultant specializing in the National Building Code (NBC) of India 2016 Volume 1.
+    # Static instructions go in the system message so the prefix is byte-identical across calls
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Context:\n{context_str}\n\nQuestion: {req.query}"}
+    ]
 
-Your job is to answer user questions using only the provided NBC context. You must ensure clarity, accuracy, and reference every answer to relevant clauses and pages.
+    return answer_key, query_embedding, None, messages
 
-Follow these strict guidelines for every response:
 
-1. ONLY use the context provided — do not guess, assume, or fabricate information.
-2. Answer concisely and clearly, using bullet points or numbered steps if appropriate.
-3. If applicable, include the **exact clause number** and page number where the answer is found.
-4. If a figure or table is referenced, include:
-   - Table/Figure number (e.g., "Table 4.3")
-   - Its title or summary
-5. If the context does **not** contain the answer, say:
-   - *“The provided NBC context does not contain information relevant to this question.”*
+# Keep proxies (nginx included) from caching or buffering the event stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-🧱 Always format your answer in this structure:
-
----
-Clause: [Clause number]
 
-Page: [Page number]
-
-Answer: 
-[Clear, direct explanation using only context.]
+def _sse(data: str, event: str = None) -> str:
+    # Multi-line payloads need one "data:" field per line
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return "\n".join(lines) + "\n\n"
 
-Reference:  
-- [Clause title]  
-- [Table/Figure if applicable]  
----
+# === Chat endpoint ===
+@app.post("/chat")
+async def chat_with_nbc(req: ChatRequest):
+    answer_key, query_embedding, answer, messages = await _prepare_chat(req)
+    if answer is not None:
+        return {"answer": answer}
 
-Tone: Professional, concise, fact-based — no opinions, filler, or friendly small talk.
+    try:
+        response = await llm_client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=MAX_TOKENS
+        )
+        answer = response.choices[0].message.content.strip()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"LLM failed: {e}")
 
-Context:
-{context_str}
+    await asyncio.get_running_loop().run_in_executor(None, _store_answer, answer_key, query_embedding, answer)
+    return {"answer": answer}
 
-Question: {req.query}
-"""
+# === Streaming chat endpoint (Server-Sent Events) ===
+@app.post("/chat/stream")
+async def chat_with_nbc_stream(req: ChatRequest):
+    answer_key, query_embedding, answer, messages = await _prepare_chat(req)
+    if answer is not None:
+        return StreamingResponse(
+            iter([_sse(answer), _sse("[DONE]")]), media_type="text/event-stream", headers=SSE_HEADERS
+        )
 
     try:
-        response = llm_client.chat.completions.create(
+        stream = await llm_client.chat.completions.create(
             model=LLM_MODEL,
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             temperature=0.3,
-            max_tokens=MAX_TOKENS
+            max_tokens=MAX_TOKENS,
+            stream=True
         )
-        return {"answer": response.choices[0].message.content.strip()}
-
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"LLM failed: {e}")
+
+    async def events():
+        parts = []
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    yield _sse(delta)
+        except Exception as e:
+            yield _sse(f"LLM failed: {e}", event="error")
+            return
+        finally:
+            # Also runs when the client disconnects: stops generation and frees the connection
+            await stream.close()
+        await asyncio.get_running_loop().run_in_executor(
+            None, _store_answer, answer_key, query_embedding, "".join(parts).strip()
+        )
+        yield _sse("[DONE]")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
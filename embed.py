@@ -1,37 +1,37 @@
-import json
+import orjson
 import uuid
+import hashlib
 from tqdm import tqdm
-from chromadb import PersistentClient
-from sentence_transformers import SentenceTransformer
+from models import COLLECTION_METADATA, encode, get_chroma, get_embedder
 
 # === Config ===
 JSON_PATH = "output/nbc_full_data.json"
-CHROMA_DIR = "chroma_store"
 COLLECTION_NAME = "nbc_data"
-EMBED_MODEL = "BAAI/bge-large-en-v1.5"
+BATCH_SIZE = 64
 
 # === Load Embedding Model ===
 print(" Loading embedding model...")
-model = SentenceTransformer(EMBED_MODEL)
+get_embedder()
 
 # === Setup ChromaDB ===
 print(" Connecting to ChromaDB...")
-client = PersistentClient(path=CHROMA_DIR)
+client = get_chroma()
 
 # Delete and recreate collection (to match new vector size)
 if COLLECTION_NAME in [c.name for c in client.list_collections()]:
     client.delete_collection(name=COLLECTION_NAME)
 
-collection = client.get_or_create_collection(name=COLLECTION_NAME)
+collection = client.get_or_create_collection(name=COLLECTION_NAME, metadata=COLLECTION_METADATA)
 
 # === Load Extracted JSON Data ===
 print(f" Loading data from {JSON_PATH}...")
-with open(JSON_PATH, "r", encoding="utf-8") as f:
-    data = json.load(f)
+with open(JSON_PATH, "rb") as f:
+    data = orjson.loads(f.read())
 
-# === Embed and Store ===
-print(" Embedding and storing...")
-for doc in tqdm(data, desc=" Embedding"):
+# === Build Texts ===
+texts, metadatas = [], []
+seen = set()
+for doc in tqdm(data, desc=" Preparing"):
     text_parts = []
 
     if doc.get("clause_number"):
@@ -58,19 +58,38 @@ for doc in tqdm(data, desc=" Embedding"):
     if not full_text:
         continue
 
-    embedding = model.encode(full_text).tolist()
+    # Repeated headers/tables yield identical blocks; embed and store each once
+    digest = hashlib.blake2b(full_text.encode("utf-8"), digest_size=16).hexdigest()
+    if digest in seen:
+        continue
+    seen.add(digest)
 
-    metadata = {
+    texts.append(full_text)
+    metadatas.append({
         "page": doc.get("page", 0),
         "clause": doc.get("clause_number", ""),
-        "title": doc.get("clause_title", "")
-    }
+        "title": doc.get("clause_title", ""),
+        "content_hash": digest  # lets later uploads skip blocks already stored
+    })
 
+# === Embed and Store ===
+print(" Embedding and storing...")
+embeddings = encode(
+    texts,
+    batch_size=BATCH_SIZE,
+    show_progress_bar=True,
+    convert_to_numpy=True,
+    normalize_embeddings=True
+).tolist()
+ids = [str(uuid.uuid4()) for _ in texts]
+
+for start in range(0, len(texts), client.max_batch_size):
+    end = start + client.max_batch_size
     collection.add(
-        documents=[full_text],
-        metadatas=[metadata],
-        embeddings=[embedding],
-        ids=[str(uuid.uuid4())]
+        documents=texts[start:end],
+        metadatas=metadatas[start:end],
+        embeddings=embeddings[start:end],
+        ids=ids[start:end]
     )
 
 print(f" Done! Stored {collection.count()} embedded documents.")
@@ -1,154 +1,149 @@
 import uuid
-import io
 import os
-import re
-import json
-import fitz
-import pdfplumber
-import pytesseract
-from PIL import Image
+import sys
+import orjson
+import zipfile
+import hashlib
+import asyncio
+import tempfile
+import threading
+import multiprocessing
+import numpy as np
 from pathlib import Path
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
-from chromadb import PersistentClient
-from sentence_transformers import SentenceTransformer
+from fastapi.responses import ORJSONResponse, Response
+from extract_pdf import Block, page_ranges, process_page_range
+from models import COLLECTION_METADATA, EMBED_ID, encode, get_chroma, get_embedder
 
 # === Constants ===
-EMBED_MODEL = "BAAI/bge-large-en-v1.5"
-CHROMA_DIR = "chroma_store"
 OUTPUT_DIR = "output"
 COLLECTION_NAME = "nbc_data"
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB
+MAX_CONCURRENT_UPLOADS = 4  # uploads held on disk and in memory at once; parsing shares page_pool
+BATCH_SIZE = 64
+PAGE_TASKS_PER_WORKER = 32  # page ranges before a worker is recycled, dropping fitz/Tesseract state
 
 # === App & Initialization ===
-app = FastAPI()
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Shared by every upload; spawned workers import only extract_pdf, never torch or Chroma
+page_pool = None
+_page_pool_lock = threading.Lock()
 
-model = SentenceTransformer(EMBED_MODEL)
-client = PersistentClient(path=CHROMA_DIR)
-
-
-# === Utilities ===
-def clean_paragraphs(text):
-    lines = text.split("\n")
-    return [
-        line.strip() for line in lines
-        if line.strip() and not re.search(r"Supply Bureau.*valid upto", line)
-    ]
-
-
-def extract_clause_blocks(text):
-    clause_pattern = re.compile(r'(?<!\d)(\d{1,2}(?:\.\d+)+)\s+([A-Z][^\n]{5,})')
-    matches = list(clause_pattern.finditer(text))
-    blocks = []
-    for i, match in enumerate(matches):
-        start = match.end()
-        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
-        clause_number = match.group(1)
-        clause_title = match.group(2).strip()
-        paragraphs = clean_paragraphs(text[start:end])
-        blocks.append({
-            "clause_number": clause_number,
-            "clause_title": clause_title,
-            "paragraphs": paragraphs
-        })
-    return blocks
 
+def _new_page_pool():
+    options = {"max_tasks_per_child": PAGE_TASKS_PER_WORKER} if sys.version_info >= (3, 11) else {}
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+        **options
+    )
 
-def find_table_title(lines, index):
-    for i in range(index - 1, max(index - 5, -1), -1):
-        line = lines[i].strip()
-        if re.match(r'^Table\s*\d+', line, re.IGNORECASE):
-            return line
-    return "Auto-detected Table"
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global page_pool
+    page_pool = _new_page_pool()
+    await asyncio.to_thread(get_embedder)
+    yield
+    page_pool.shutdown()
 
-def extract_tables_from_page(pdf_path, page_number):
-    tables = []
-    try:
-        with pdfplumber.open(pdf_path) as pdf:
-            if page_number < len(pdf.pages):
-                page = pdf.pages[page_number]
-                lines = page.extract_text().split("\n") if page.extract_text() else []
-                raw_tables = page.extract_tables()
-                for idx, tbl in enumerate(raw_tables):
-                    if not tbl or len(tbl) < 2:
-                        continue
-                    title = find_table_title(lines, idx)
-                    header, *rows = tbl
-                    tables.append({
-                        "title": title,
-                        "columns": [c.strip() if c else "" for c in header],
-                        "rows": [[c.strip() if c else "" for c in row] for row in rows],
-                        "notes": []
-                    })
-    except Exception:
-        pass
-    return tables
-
-
-def extract_figures(text):
-    figures = re.findall(r'(Fig(?:ure)?\.?\s*\d+[^:\n]*)', text, re.IGNORECASE)
-    result = []
-    for fig in figures:
-        parts = fig.split(None, 2)
-        if len(parts) >= 3:
-            result.append({"figure_number": parts[1].strip("."), "title": parts[2].strip()})
-        elif len(parts) == 2:
-            result.append({"figure_number": parts[1].strip("."), "title": ""})
-    return result
-
-
-def ocr_text_from_fitz_page(page):
-    pix = page.get_pixmap(dpi=300)
-    img = Image.open(io.BytesIO(pix.tobytes("png")))
-    return pytesseract.image_to_string(img)
-
-
-def process_pdf(pdf_path: str):
-    doc = fitz.open(pdf_path)
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+client = get_chroma()
+# Serializes stores: concurrent uploads would otherwise race the content_hash check
+_store_lock = threading.Lock()
+
+
+# === PDF Parsing ===
+def process_pdf(pdf_path: str) -> List[Block]:
+    global page_pool
+    pool = page_pool
     structured_data = []
-    for page_num, page in enumerate(doc):
-        try:
-            text = page.get_text("text")
-        except Exception:
-            text = ""
-        if not text or len(text.strip()) < 20:
-            text = ocr_text_from_fitz_page(page)
-        text_cleaned = "\n".join(clean_paragraphs(text))
-        clause_blocks = extract_clause_blocks(text_cleaned)
-        tables = extract_tables_from_page(pdf_path, page_num)
-        figures = extract_figures(text_cleaned)
-
-        if clause_blocks:
-            for block in clause_blocks:
-                block.update({
-                    "page": page_num + 1,
-                    "tables": tables,
-                    "figures": figures
-                })
-                structured_data.append(block)
-        else:
-            structured_data.append({
-                "clause_number": "",
-                "clause_title": "",
-                "page": page_num + 1,
-                "paragraphs": clean_paragraphs(text_cleaned),
-                "tables": tables,
-                "figures": figures
-            })
+    try:
+        for blocks in pool.map(process_page_range, page_ranges(pdf_path)):
+            structured_data.extend(blocks)
+    except BrokenProcessPool:
+        # A worker died (MuPDF/Tesseract crash, OOM kill) and the pool is unusable from now on.
+        # Replace it for later uploads; this one fails, since a retry may just crash it again.
+        with _page_pool_lock:
+            if page_pool is pool:
+                page_pool = _new_page_pool()
+                pool.shutdown(wait=False)
+        raise
     return structured_data
 
 
-def embed_and_store(data, collection_name: str):
-    collection = client.get_or_create_collection(name=collection_name)
+def get_collection(collection_name: str):
+    rebuild_name = f"{collection_name}_rebuild"
+    names = [c.name for c in client.list_collections()]
+    if collection_name not in names:
+        if rebuild_name in names:
+            # A rebuild finished but died before the rename; its copy is complete
+            collection = client.get_collection(name=rebuild_name)
+            collection.modify(name=collection_name)
+            return collection
+        return client.create_collection(name=collection_name, metadata=COLLECTION_METADATA)
+
+    collection = client.get_collection(name=collection_name)
+    current = collection.metadata or {}
+    if all(current.get(key) == value for key, value in COLLECTION_METADATA.items()):
+        return collection
+
+    # HNSW settings are frozen at creation, so copy the stored vectors into a new collection.
+    # The old one is only dropped once the copy is complete; a failed rebuild leaves it intact.
+    if rebuild_name in names:
+        client.delete_collection(name=rebuild_name)
+    existing = collection.get(include=["documents", "metadatas", "embeddings"])
+    rebuilt = client.create_collection(name=rebuild_name, metadata=COLLECTION_METADATA)
+    for start in range(0, len(existing["ids"]), client.max_batch_size):
+        end = start + client.max_batch_size
+        rebuilt.add(
+            documents=existing["documents"][start:end],
+            metadatas=existing["metadatas"][start:end],
+            embeddings=existing["embeddings"][start:end],
+            ids=existing["ids"][start:end]
+        )
+    client.delete_collection(name=collection_name)
+    rebuilt.modify(name=collection_name)
+    return rebuilt
+
 
+def load_embeddings(embeddings_path):
+    # Content digest -> embedding from a previous run's sidecar, if it used the same model/backend
+    if not embeddings_path or not os.path.exists(embeddings_path):
+        return {}
+    try:
+        with np.load(embeddings_path) as sidecar:
+            if str(sidecar["model"]) != EMBED_ID:
+                return {}
+            return dict(zip(sidecar["digests"].tolist(), sidecar["embeddings"]))
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        # Unreadable sidecar: re-encode rather than fail every upload of this file
+        return {}
+
+
+def embed_and_store(data: List[Block], collection_name: str, embeddings_path=None):
+    with _store_lock:
+        return _embed_and_store(data, collection_name, embeddings_path)
+
+
+def _embed_and_store(data: List[Block], collection_name: str, embeddings_path=None):
+    collection = get_collection(collection_name)
+
+    texts, metadatas, digests = [], [], []
+    seen = set()
     for doc in data:
         text_parts = []
-        if doc.get("clause_number"):
-            text_parts.append(f"Clause {doc['clause_number']}: {doc.get('clause_title', '')}")
-        text_parts += [p.strip() for p in doc.get("paragraphs", []) if p.strip()]
+        if doc.clause_number:
+            text_parts.append(f"Clause {doc.clause_number}: {doc.clause_title}")
+        text_parts += [p.strip() for p in doc.paragraphs if p.strip()]
 
-        for table in doc.get("tables", []):
+        for table in doc.tables:
             if table.get("title"):
                 text_parts.append(f"Table: {table['title']}")
             if "columns" in table:
@@ -156,85 +151,170 @@ def embed_and_store(data, collection_name: str):
             text_parts += [" | ".join(row) for row in table.get("rows", [])]
             text_parts += [f"Note: {note}" for note in table.get("notes", [])]
 
-        for fig in doc.get("figures", []):
+        for fig in doc.figures:
             text_parts.append(f"Figure {fig.get('figure_number')}: {fig.get('title', '')}")
 
         full_text = " ".join(text_parts).strip()
         if not full_text:
             continue
 
-        embedding = model.encode(full_text).tolist()
-        metadata = {
-            "page": doc.get("page", 0),
-            "clause": doc.get("clause_number", ""),
-            "title": doc.get("clause_title", "")
-        }
+        # Repeated headers/tables yield identical blocks; embed and store each once
+        digest = hashlib.blake2b(full_text.encode("utf-8"), digest_size=16).hexdigest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+
+        texts.append(full_text)
+        digests.append(digest)
+        metadatas.append({
+            "page": doc.page,
+            "clause": doc.clause_number,
+            "title": doc.clause_title,
+            "content_hash": digest
+        })
 
+    # Blocks already in the collection (e.g. from an earlier upload) are not added again
+    stored = set()
+    for start in range(0, len(digests), client.max_batch_size):
+        found = collection.get(
+            where={"content_hash": {"$in": digests[start:start + client.max_batch_size]}},
+            include=["metadatas"]
+        )
+        stored.update(meta["content_hash"] for meta in found["metadatas"])
+    new = [i for i, digest in enumerate(digests) if digest not in stored]
+
+    # Only encode texts the sidecar has not seen; unchanged blocks reuse stored vectors
+    cached = load_embeddings(embeddings_path)
+    missing = [i for i in new if digests[i] not in cached]
+    if missing:
+        encoded = encode(
+            [texts[i] for i in missing],
+            batch_size=BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        for i, embedding in zip(missing, encoded):
+            cached[digests[i]] = embedding
+
+    known = [digest for digest in digests if digest in cached]
+    if embeddings_path and known:
+        # fp16 halves the sidecar; normalized BGE vectors keep their ranking within noise.
+        # Written aside and renamed, so a crash or full disk never leaves a truncated sidecar.
+        partial_path = f"{embeddings_path}.partial"
+        with open(partial_path, "wb") as f:
+            np.savez(
+                f,
+                model=EMBED_ID,
+                digests=np.array(known),
+                embeddings=np.stack([cached[digest] for digest in known]).astype(np.float16)
+            )
+        os.replace(partial_path, embeddings_path)
+
+    if not new:
+        return collection.count()
+
+    texts = [texts[i] for i in new]
+    metadatas = [metadatas[i] for i in new]
+    embeddings = np.stack([cached[digests[i]] for i in new]).astype(np.float32).tolist()
+    ids = [str(uuid.uuid4()) for _ in texts]
+
+    # One add() unless the file exceeds what Chroma accepts per call
+    for start in range(0, len(texts), client.max_batch_size):
+        end = start + client.max_batch_size
         collection.add(
-            documents=[full_text],
-            metadatas=[metadata],
-            embeddings=[embedding],
-            ids=[str(uuid.uuid4())]
+            documents=texts[start:end],
+            metadatas=metadatas[start:end],
+            embeddings=embeddings[start:end],
+            ids=ids[start:end]
         )
     return collection.count()
 
 
-# === API Routes ===
+# === Upload Ingestion ===
+def _write_json(path, data):
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
-@app.post("/upload_pdf")
-async def upload_pdf(file: UploadFile = File(...)):
-    filename = file.filename
-    temp_pdf_path = f"temp_{uuid.uuid4()}.pdf"
 
-    with open(temp_pdf_path, "wb") as f:
-        f.write(await file.read())
+async def _ingest_upload(file: UploadFile):
+    filename = file.filename
+    tmp = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
 
     try:
-        # Process & store
-        structured_data = process_pdf(temp_pdf_path)
+        # Stream to disk in chunks instead of holding the whole upload in memory
+        with tmp:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                tmp.write(chunk)
+
+        # Process & store off the event loop so other requests are served meanwhile
+        structured_data = await asyncio.to_thread(process_pdf, tmp.name)
         json_filename = f"{Path(filename).stem}.json"
         json_path = os.path.join(OUTPUT_DIR, json_filename)
+        embeddings_path = os.path.join(OUTPUT_DIR, f"{Path(filename).stem}.npz")
 
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(structured_data, f, indent=2, ensure_ascii=False)
-
-        count = embed_and_store(structured_data, collection_name=COLLECTION_NAME)
+        await asyncio.to_thread(_write_json, json_path, structured_data)
+        count = await asyncio.to_thread(
+            embed_and_store, structured_data, COLLECTION_NAME, embeddings_path
+        )
 
-        return JSONResponse({
+        return {
             "message": f"✅ Processed '{filename}' and added {count} entries to ChromaDB collection '{COLLECTION_NAME}'",
             "collection": COLLECTION_NAME,
             "count": count,
             "output_json": json_filename
-        })
+        }
     finally:
-        os.remove(temp_pdf_path)
+        os.unlink(tmp.name)
+
+# === API Routes ===
+
+@app.post("/upload_pdf")
+async def upload_pdf(file: UploadFile = File(...)):
+    return ORJSONResponse(await _ingest_upload(file))
+
+
+@app.post("/upload_pdfs")
+async def upload_pdfs(files: List[UploadFile] = File(...)):
+    sem = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+    async def _one(file: UploadFile):
+        # Report each file on its own; one bad PDF must not hide the others' stored results
+        async with sem:
+            try:
+                return {"file": file.filename, **await _ingest_upload(file)}
+            except Exception as e:
+                return {"file": file.filename, "error": str(e)}
+
+    results = await asyncio.gather(*[_one(f) for f in files])
+    return ORJSONResponse({"results": results})
 
 
 @app.get("/pdf_data/{file_id}")
 def get_pdf_data(file_id: str):
     json_path = os.path.join(OUTPUT_DIR, f"{file_id}.json")
     if not os.path.exists(json_path):
-        return JSONResponse({"error": "File not found"}, status_code=404)
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    return data
+        return ORJSONResponse({"error": "File not found"}, status_code=404)
+    # The file is already JSON; serve its bytes rather than parsing and re-encoding them
+    with open(json_path, "rb") as f:
+        return Response(content=f.read(), media_type="application/json")
 
 
 @app.put("/update_pdf/{file_id}")
 def update_pdf(file_id: str):
     json_path = os.path.join(OUTPUT_DIR, f"{file_id}.json")
     if not os.path.exists(json_path):
-        return JSONResponse({"error": "File not found"}, status_code=404)
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    count = embed_and_store(data, COLLECTION_NAME)
+        return ORJSONResponse({"error": "File not found"}, status_code=404)
+    with open(json_path, "rb") as f:
+        data = [Block(**block) for block in orjson.loads(f.read())]
+    embeddings_path = os.path.join(OUTPUT_DIR, f"{file_id}.npz")
+    count = embed_and_store(data, COLLECTION_NAME, embeddings_path)
     return {"message": f"✅ Updated embeddings in '{COLLECTION_NAME}' from '{file_id}.json'", "updated_count": count}
 
 
 @app.delete("/delete_pdf/{file_id}")
 def delete_pdf(file_id: str):
-    json_path = os.path.join(OUTPUT_DIR, f"{file_id}.json")
-    if os.path.exists(json_path):
-        os.remove(json_path)
+    for path in (os.path.join(OUTPUT_DIR, f"{file_id}.json"), os.path.join(OUTPUT_DIR, f"{file_id}.npz")):
+        if os.path.exists(path):
+            os.remove(path)
     return {
         "message": f"Deleted JSON '{file_id}.json'. Note: Embeddings are still in ChromaDB unless deleted separately."}
@@ -136,32 +136,50 @@ import fitz  # PyMuPDF
 import pdfplumber
 import pytesseract
 from PIL import Image
-import io
-import json
+import orjson
+import os
 from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+try:
+    import tesserocr  # optional: keeps Tesseract loaded in-process between pages
+except ImportError:
+    tesserocr = None
+
 PDF_PATH = "data/NBC 2016 Vol 1.PDF"
 OUTPUT_FILE = "output/nbc_full_data.json"
+PAGES_PER_TASK = 16
+OCR_DPI = 200  # enough for Tesseract on printed text
+OCR_MIN_TEXT_CHARS = 100
+
+# === Patterns (compiled once, used per line/page) ===
+# Matches every line except the licence footer, so one C-level sweep filters a page
+_LINE_RE = re.compile(r"^(?!.*Supply Bureau.*valid upto)(.*)$", re.MULTILINE)
+_CLAUSE_RE = re.compile(r'(?<!\d)(\d{1,2}(?:\.\d+)+)\s+([A-Z][^\n]{5,})')
+_TABLE_TITLE_RE = re.compile(r'^Table\s*\d+', re.IGNORECASE)
+_FIGURE_RE = re.compile(r'(Fig(?:ure)?\.?\s*\d+[^:\n]*)', re.IGNORECASE)
+
+# === Structured Data ===
+# One per clause (or per page without clauses); slots keep thousands of them small
+@dataclass(slots=True)
+class Block:
+    clause_number: str = ""
+    clause_title: str = ""
+    page: int = 0
+    paragraphs: list = field(default_factory=list)
+    tables: list = field(default_factory=list)
+    figures: list = field(default_factory=list)
 
 # === Clean Paragraphs and Remove Footer ===
 def clean_paragraphs(text):
-    lines = text.split("\n")
-    cleaned = []
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        # Remove known footer pattern
-        if re.search(r"Supply Bureau.*valid upto", line):
-            continue
-        cleaned.append(line)
-    return cleaned
+    lines = (match.group(1).strip() for match in _LINE_RE.finditer(text))
+    return [line for line in lines if line]
 
 # === Clause Block Extraction (Hierarchical Style) ===
 def extract_clause_blocks(text):
-    clause_pattern = re.compile(r'(?<!\d)(\d{1,2}(?:\.\d+)+)\s+([A-Z][^\n]{5,})')
-    matches = list(clause_pattern.finditer(text))
+    matches = list(_CLAUSE_RE.finditer(text))
     blocks = []
     for i, match in enumerate(matches):
         start = match.end()
@@ -170,49 +188,47 @@ def extract_clause_blocks(text):
         clause_title = match.group(2).strip()
         paragraph_text = text[start:end]
         paragraphs = clean_paragraphs(paragraph_text)
-        blocks.append({
-            "clause_number": clause_number,
-            "clause_title": clause_title,
-            "paragraphs": paragraphs
-        })
+        blocks.append(Block(clause_number, clause_title, paragraphs=paragraphs))
     return blocks
 
 # === Table Title Detection (lines above table) ===
 def find_table_title(lines, index):
     for i in range(index - 1, max(index - 5, -1), -1):
         line = lines[i].strip()
-        if re.match(r'^Table\s*\d+', line, re.IGNORECASE):
+        if _TABLE_TITLE_RE.match(line):
             return line
     return "Auto-detected Table"
 
 # === Extract Tables with Titles ===
-def extract_tables_from_page(pdf_path, page_number):
+def extract_tables_from_page(plumber_page, text_lines):
     tables = []
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            if page_number < len(pdf.pages):
-                page = pdf.pages[page_number]
-                lines = page.extract_text().split("\n") if page.extract_text() else []
-
-                raw_tables = page.extract_tables()
-                for idx, tbl in enumerate(raw_tables):
-                    if not tbl or len(tbl) < 2:
-                        continue
-                    title = find_table_title(lines, idx)
-                    header, *rows = tbl
-                    tables.append({
-                        "title": title,
-                        "columns": [c.strip() if c else "" for c in header],
-                        "rows": [[c.strip() if c else "" for c in row] for row in rows],
-                        "notes": []
-                    })
+        raw_tables = plumber_page.extract_tables()
+        for idx, tbl in enumerate(raw_tables):
+            if not tbl or len(tbl) < 2:
+                continue
+            title = find_table_title(text_lines, idx)
+            header, *rows = tbl
+            tables.append({
+                "title": title,
+                "columns": [c.strip() if c else "" for c in header],
+                "rows": [[c.strip() if c else "" for c in row] for row in rows],
+                "notes": []
+            })
     except Exception:
         pass
     return tables
 
+# === Cheap Table Probe (PyMuPDF) ===
+def page_has_tables(page):
+    try:
+        return bool(page.find_tables().tables)
+    except Exception:
+        return True  # let pdfplumber decide
+
 # === Extract Figure Captions (e.g., Fig. 5 Title) ===
 def extract_figures(text):
-    figures = re.findall(r'(Fig(?:ure)?\.?\s*\d+[^:\n]*)', text, re.IGNORECASE)
+    figures = _FIGURE_RE.findall(text)
     result = []
     for fig in figures:
         parts = fig.split(None, 2)
@@ -226,51 +242,90 @@ def extract_figures(text):
             })
     return result
 
-# === Fallback OCR using PyTesseract ===
+# === Fallback OCR (tesserocr if installed, else PyTesseract) ===
+_tess_api = None
+
+def _get_tess_api():
+    # One API per worker process; a PyTessBaseAPI must not be shared across threads
+    global _tess_api, tesserocr
+    if _tess_api is None:
+        try:
+            _tess_api = tesserocr.PyTessBaseAPI()
+        except RuntimeError:
+            # e.g. tessdata not where tesserocr was built to look; use PyTesseract from now on
+            tesserocr = None
+    return _tess_api
+
 def ocr_text_from_fitz_page(page):
-    pix = page.get_pixmap(dpi=300)
-    img = Image.open(io.BytesIO(pix.tobytes("png")))
-    text = pytesseract.image_to_string(img)
-    return text
+    pix = page.get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+    # Wrap fitz's grayscale sample buffer directly: no PNG round trip and no pixel copy
+    img = Image.frombuffer("L", (pix.width, pix.height), pix.samples_mv, "raw", "L", pix.stride, 1)
+    api = _get_tess_api() if tesserocr is not None else None
+    if api is None:
+        return pytesseract.image_to_string(img)
+    api.SetImage(img)
+    return api.GetUTF8Text()
 
-# === Process Full PDF ===
-def process_pdf(pdf_path):
-    doc = fitz.open(pdf_path)
+# === Process a Range of Pages (runs in a worker process) ===
+# Keep this module free of torch/Chroma imports: the API's spawned page workers import it
+def process_page_range(args):
+    pdf_path, start, end = args
     structured_data = []
 
-    for page_num in tqdm(range(len(doc)), desc="📄 Parsing PDF"):
-        page = doc[page_num]
-        try:
-            text = page.get_text("text")
-        except Exception:
-            text = ""
+    # Open both parsers once per range; reopening per page reparses the whole file
+    with fitz.open(pdf_path) as doc, pdfplumber.open(pdf_path) as plumber_pdf:
+        for page_num in range(start, end):
+            page = doc[page_num]
+            try:
+                text = page.get_text("text")
+            except Exception:
+                text = ""
 
-        # OCR fallback
-        if not text or len(text.strip()) < 20:
-            text = ocr_text_from_fitz_page(page)
+            # OCR fallback, only for scanned pages (little text, embedded images)
+            if len(text.strip()) < OCR_MIN_TEXT_CHARS and page.get_images():
+                text = ocr_text_from_fitz_page(page)
 
-        text_cleaned = "\n".join(clean_paragraphs(text))
-        clause_blocks = extract_clause_blocks(text_cleaned)
-        tables = extract_tables_from_page(pdf_path, page_num)
-        figures = extract_figures(text_cleaned)
+            text_cleaned = "\n".join(clean_paragraphs(text))
+            clause_blocks = extract_clause_blocks(text_cleaned)
+            # pdfplumber's extractor is far slower; only run it where fitz sees a table
+            tables = []
+            if page_has_tables(page):
+                tables = extract_tables_from_page(plumber_pdf.pages[page_num], text_cleaned.split("\n"))
+            figures = extract_figures(text_cleaned)
 
-        if clause_blocks:
-            for block in clause_blocks:
-                block.update({
-                    "page": page_num + 1,
-                    "tables": tables,
-                    "figures": figures
-                })
-                structured_data.append(block)
-        else:
-            structured_data.append({
-                "clause_number": "",
-                "clause_title": "",
-                "page": page_num + 1,
-                "paragraphs": clean_paragraphs(text_cleaned),
-                "tables": tables,
-                "figures": figures
-            })
+            if clause_blocks:
+                for block in clause_blocks:
+                    block.page = page_num + 1
+                    block.tables = tables
+                    block.figures = figures
+                    structured_data.append(block)
+            else:
+                structured_data.append(Block(
+                    page=page_num + 1,
+                    paragraphs=clean_paragraphs(text_cleaned),
+                    tables=tables,
+                    figures=figures
+                ))
+
+    return structured_data
+
+# === Process Full PDF ===
+def page_ranges(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    return [
+        (pdf_path, start, min(start + PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, PAGES_PER_TASK)
+    ]
+
+def process_pdf(pdf_path):
+    ranges = page_ranges(pdf_path)
+    structured_data = []
+    # Pages are independent, so ranges parse in parallel; map() keeps page order
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(process_page_range, ranges)
+        for blocks in tqdm(results, total=len(ranges), desc="📄 Parsing PDF"):
+            structured_data.extend(blocks)
 
     return structured_data
 
@@ -278,6 +333,6 @@ def process_pdf(pdf_path):
 if __name__ == "__main__":
     Path("output").mkdir(exist_ok=True)
     structured = process_pdf(PDF_PATH)
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(structured, f, indent=2, ensure_ascii=False)
+    with open(OUTPUT_FILE, "wb") as f:
+        f.write(orjson.dumps(structured, option=orjson.OPT_INDENT_2))
     print(f" Done. Output saved to {OUTPUT_FILE}")
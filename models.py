@@ -0,0 +1,103 @@
+import os
+import shutil
+from functools import lru_cache
+import numpy as np
+import torch
+import chromadb
+from dotenv import load_dotenv
+from sentence_transformers import SentenceTransformer
+
+# === Load environment ===
+load_dotenv()
+
+# === Constants ===
+CHROMA_DIR = "chroma_store"
+# Index and query must use the same model (e.g. BAAI/bge-small-en-v1.5 after a reindex)
+EMBED_MODEL = os.getenv("EMBED_MODEL", "BAAI/bge-large-en-v1.5")
+# "onnx" runs an INT8-quantized ONNX export on CPU (needs optimum[onnxruntime])
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+# Names the vectors, not just the weights: backends differ numerically, so cache keys use this
+EMBED_ID = f"{EMBED_MODEL}@{EMBED_BACKEND}"
+ONNX_DIR = "onnx_models"
+MAX_SEQ_LENGTH = 512
+# HNSW settings for every collection this project creates; frozen once a collection exists
+COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 24,
+    "hnsw:construction_ef": 128,
+    "hnsw:search_ef": 100
+}
+
+# === ONNX Runtime backend ===
+class OnnxEmbedder:
+    # Drop-in for the parts of SentenceTransformer.encode this project uses; BGE pools on [CLS]
+    def __init__(self, model_name: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        export_dir = os.path.join(ONNX_DIR, model_name.replace("/", "__"))
+        quantized_dir = f"{export_dir}-int8"
+        if not os.path.exists(os.path.join(quantized_dir, "model_quantized.onnx")):
+            # One-off export + dynamic INT8 quantization, reused on later starts.
+            # Built in a staging dir and renamed last, so an interrupted run is redone, not loaded.
+            staging_dir = f"{quantized_dir}.partial"
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            ort_model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            ort_model.save_pretrained(export_dir)
+            quantizer = ORTQuantizer.from_pretrained(export_dir)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=staging_dir, quantization_config=qconfig)
+            ort_model.config.save_pretrained(staging_dir)
+            shutil.rmtree(quantized_dir, ignore_errors=True)  # leftovers from an older, unstaged run
+            os.replace(staging_dir, quantized_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            quantized_dir, file_name="model_quantized.onnx"
+        )
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(
+                sentences[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQ_LENGTH,
+                return_tensors="np"
+            )
+            batches.append(np.asarray(self.model(**inputs).last_hidden_state)[:, 0])
+        embeddings = np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+
+        if normalize_embeddings and len(embeddings):
+            embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings[0] if single else embeddings
+
+# === Shared instances (one per process, whichever module asks first) ===
+@lru_cache(maxsize=1)
+def get_embedder():
+    # Container images often leave torch on one thread; size it unless OMP_NUM_THREADS is set
+    if "OMP_NUM_THREADS" not in os.environ:
+        torch.set_num_threads(min(os.cpu_count() or 4, 8))
+    if EMBED_BACKEND == "onnx":
+        return OnnxEmbedder(EMBED_MODEL)
+    model = SentenceTransformer(EMBED_MODEL)
+    if torch.cuda.is_available():
+        model = model.half()  # FP16 doubles Tensor Core throughput
+    return model
+
+
+@lru_cache(maxsize=1)
+def get_chroma():
+    return chromadb.PersistentClient(path=CHROMA_DIR)
+
+# === Encoding ===
+def encode(texts, **kwargs):
+    # inference_mode also drops the version-counter/view tracking that no_grad keeps
+    with torch.inference_mode():
+        return get_embedder().encode(texts, **kwargs)